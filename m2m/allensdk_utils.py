@@ -1,6 +1,12 @@
 import os
+import time
+import urllib.error
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd
+import requests
 from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 from allensdk.api.queries.mouse_connectivity_api import MouseConnectivityApi
 from allensdk.api.queries.reference_space_api import ReferenceSpaceApi
@@ -9,6 +15,147 @@ import nrrd
 from m2m.control import (get_cached_dir, get_cache_dir)
 
 
+def is_transient_error(error):
+    """
+    Whether an Allen API error is worth retrying: connection errors,
+    timeouts and server errors (5xx).
+    Client errors (4xx) would fail again the same way.
+
+    Parameters
+    ----------
+    error: Exception
+        Error raised by an Allen API query.
+
+    Returns
+    -------
+    bool: Whether the query can be retried.
+    """
+    # HTTP errors (requests, urllib) carry a status code
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None and isinstance(error, urllib.error.HTTPError):
+        status = error.code
+    if status is not None:
+        return status >= 500
+
+    return isinstance(error, (ConnectionError, TimeoutError,
+                              requests.ConnectionError,
+                              requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError,
+                              urllib.error.URLError))
+
+
+def retry_allen_query(query, *args, retries=3, backoff=0.3, **kwargs):
+    """
+    Call an Allen API query, retrying it with an exponential
+    backoff if the connection fails (is_transient_error()).
+    Other errors are raised at once.
+
+    Parameters
+    ----------
+    query: callable
+        AllenSDK function or method to call.
+    *args, **kwargs:
+        Arguments of the query.
+    retries: int
+        Maximum number of attempts.
+    backoff: float
+        Delay before the first retry, in seconds.
+        Doubled after each failed attempt.
+
+    Returns
+    -------
+    Result of the query.
+    """
+    for attempt in range(retries):
+        try:
+            return query(*args, **kwargs)
+        except Exception as error:
+            if attempt == retries - 1 or not is_transient_error(error):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def retry_allen_download(download, path):
+    """
+    Download a file with an Allen API query, retrying it if the
+    connection fails (retry_allen_query()).\n
+    The file is downloaded to a unique file next to path, then
+    renamed, so an interrupted download never leaves a partial file
+    in cache, and concurrent downloads of the same file (in one run or
+    by several processes) never remove each other's file.
+
+    Parameters
+    ----------
+    download: callable
+        Download query, writing the file to the path it is given.
+        The file already exists (empty), so it must be overwritten
+        (AllenSDK strategy='create').
+    path: Path
+        Path to the downloaded file.
+
+    Returns
+    -------
+    Path: Downloaded file.
+    """
+    path = Path(path)
+
+    def attempt():
+        # Unique name, created with the usual (umask) file permissions
+        part = str(path.with_name(f'{path.name}.{uuid.uuid4().hex}.part'))
+        open(part, 'xb').close()
+        try:
+            download(part)
+            os.replace(part, path)
+        except BaseException:
+            # Removing the partial file of this attempt only
+            if os.path.isfile(part):
+                os.remove(part)
+            raise
+
+    retry_allen_query(attempt)
+    return path
+
+
+@lru_cache(maxsize=None)
+def get_mca():
+    """
+    Get the Allen Mouse Connectivity Api.
+    A single instance is shared by all the queries.
+
+    Returns
+    -------
+    mca: MouseConnectivityApi()
+    """
+    return MouseConnectivityApi()
+
+
+@lru_cache(maxsize=None)
+def get_rsa():
+    """
+    Get the Allen Reference Space Api.
+    A single instance is shared by all the queries.
+
+    Returns
+    -------
+    rsa: ReferenceSpaceApi()
+    """
+    return ReferenceSpaceApi()
+
+
+@lru_cache(maxsize=None)
+def get_tsa():
+    """
+    Get the Allen Tree Search Api.
+    A single instance is shared by all the queries.
+
+    Returns
+    -------
+    tsa: TreeSearchApi()
+    """
+    return TreeSearchApi()
+
+
 def get_mcc(nocache, res):
     """
     Get Allen Mouse Connectivity Cache.
@@ -34,7 +181,7 @@ def get_mcc(nocache, res):
     return MouseConnectivityCache(resolution=res, manifest_file=manifest_path)
 
 
-def get_mcc_exps(nocache):
+def get_mcc_exps(nocache, mcc=None):
     """
     Get Mouse Connectivity Cache experiments.
     Stored in a hidden folder.
@@ -44,12 +191,15 @@ def get_mcc_exps(nocache):
     ----------
     nocache: bool
         Whether use cache of not
+    mcc: MouseConnectivityCache, optional
+        Cache (from get_mcc()) to reuse.
 
     Return
     ------
     dataframe : Allen Mouse Connectivity experiments
     """
-    mcc = get_mcc(nocache, None)
+    if mcc is None:
+        mcc = get_mcc(nocache, None)
     experiments_path = os.path.join(get_cached_dir("cache"),
                                     'allen_mouse_conn_experiments.json')
 
@@ -57,13 +207,12 @@ def get_mcc_exps(nocache):
         if os.path.isfile(experiments_path):
             os.remove(experiments_path)
 
-    experiments = mcc.get_experiments(dataframe=True,
-                                      file_name=experiments_path)
+    # Already a dataframe (indexed by experiment id), returned as is
+    return mcc.get_experiments(dataframe=True,
+                               file_name=experiments_path)
 
-    return pd.DataFrame(experiments)
 
-
-def get_mcc_stree(nocache):
+def get_mcc_stree(nocache, mcc=None):
     """
     Get allen Mouse Brain structure tree.
     Json stored in a hidden folder.
@@ -73,12 +222,15 @@ def get_mcc_stree(nocache):
     ----------
     nocache: bool
         Whether use cache of not
+    mcc: MouseConnectivityCache, optional
+        Cache (from get_mcc()) to reuse.
 
     Return
     ------
     dataframe : Allen Mouse Brain structure tree
     """
-    mcc = get_mcc(nocache, None)
+    if mcc is None:
+        mcc = get_mcc(nocache, None)
     structures_path = os.path.join(get_cached_dir("cache"), 'structures.json')
 
     if nocache:
@@ -106,10 +258,12 @@ def get_injection_infos(allen_experiments, id):
     list: coordinates of the injection coordinates
     string: Injection location (R or L).
     """
-    roi = allen_experiments.loc[id].structure_abbrev
-    inj_x = allen_experiments.loc[id].injection_x
-    inj_y = allen_experiments.loc[id].injection_y
-    inj_z = allen_experiments.loc[id].injection_z
+    # Single row lookup (experiments are indexed by id)
+    experiment = allen_experiments.loc[id]
+    roi = experiment.structure_abbrev
+    inj_x = experiment.injection_x
+    inj_y = experiment.injection_y
+    inj_z = experiment.injection_z
     pos = [inj_x, inj_y, inj_z]
     if inj_z >= 11400/2:
         loc = 'R'
@@ -119,10 +273,12 @@ def get_injection_infos(allen_experiments, id):
     return roi, pos, loc
 
 
-def download_proj_density_vol(file, id, res, nocache):
+def download_proj_density(file, id, res, nocache):
     """
-    Download projection density map and store it in cache
-    by default.
+    Download projection density map and store it in cache.
+    The cached file is reused by the next calls with the same
+    filename (id and resolution).\n
+    The map is only downloaded, not read.
 
     Parameters
     ----------
@@ -133,67 +289,137 @@ def download_proj_density_vol(file, id, res, nocache):
     res: int
         Allen resolution [25, 50, 100]
     nocache: bool
-        Whether use cache of not
+        Whether use cache of not.
+        Setting nocache to True download the map again.
 
     Returns
     -------
-    ndarray:
-        Projection density volume.
+    Path:
+        Cached projection density map file (.nrrd).
     """
     cache_dir = Path(get_cached_dir('cache_proj_density'))
     cache_dir.mkdir(exist_ok=True, parents=True)
-    if not os.path.isfile(cache_dir / file):
-        mcc = get_mcc(nocache, res)
-        mcc.get_projection_density(
-            file_name=cache_dir / file,
-            experiment_id=id)
-    vol, hdr = nrrd.read(cache_dir / file)
-    if nocache:
+    if nocache and os.path.isfile(cache_dir / file):
         os.remove(cache_dir / file)
-    return vol
+    if not os.path.isfile(cache_dir / file):
+        mca = get_mca()
+        retry_allen_download(
+            lambda part: mca.download_projection_density(
+                part, experiment_id=id, resolution=res,
+                strategy='create'),
+            cache_dir / file)
+    return cache_dir / file
 
 
-def download_struct_mask_vol(file, id, res, nocache):
+def download_proj_densities(files, ids, res, nocache):
     """
-    Download a structure mask and store it in cache
-    by default.
+    Download several projection density maps concurrently
+    and store them in cache.\n
+    The downloads are network bound, so they run in a pool
+    of 8 threads.
+
+    Parameters
+    ----------
+    files: list
+        Downloaded filenames.
+    ids: list of int
+        Allen mouse connectiviy experiments ids.
+    res: int
+        Allen resolution [25, 50, 100]
+    nocache: bool
+        Whether use cache of not.
+        Setting nocache to True download the maps again.
+
+    Returns
+    -------
+    list of Path:
+        Cached projection density maps files (.nrrd),
+        in the same order as ids.
+    """
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(
+            lambda file, id: download_proj_density(file, id, res, nocache),
+            files, ids))
+
+
+def download_struct_mask(file, id, res, nocache):
+    """
+    Download a structure mask and store it in cache.
+    The cached file is reused by the next calls with the same
+    filename (id and resolution).\n
+    The mask is only downloaded, not read.
 
     Parameters
     ----------
     file:
         Downloaded filename.
     id: int
-        Allen mouse connectiviy experiment id.
+        Allen Mouse Brain Atlas structure id.
     res: int
         Allen resolution [25, 50, 100]
     nocache: bool
-        Whether use cache of not
+        Whether use cache of not.
+        Setting nocache to True download the mask again.
 
     Returns
     -------
-    ndarray:
-        Structure mask volume.
+    Path:
+        Cached structure mask file (.nrrd).
     """
     cache_dir = Path(get_cached_dir('cache_struct_mask'))
     cache_dir.mkdir(exist_ok=True, parents=True)
-    if not os.path.isfile(cache_dir / file):
-        rsa = ReferenceSpaceApi()
-        rsa.download_structure_mask(
-            structure_id=id,
-            ccf_version=rsa.CCF_VERSION_DEFAULT,
-            resolution=res,
-            file_name=cache_dir / file
-                )
-    vol, hdr = nrrd.read(cache_dir / file)
-    if nocache:
+    if nocache and os.path.isfile(cache_dir / file):
         os.remove(cache_dir / file)
-    return vol
+    if not os.path.isfile(cache_dir / file):
+        rsa = get_rsa()
+        # Downloading only (no reader), the mask is read by the caller
+        retry_allen_download(
+            lambda part: rsa.download_structure_mask(
+                structure_id=id,
+                ccf_version=rsa.CCF_VERSION_DEFAULT,
+                resolution=res,
+                file_name=part,
+                strategy='create',
+                reader=None),
+            cache_dir / file)
+    return cache_dir / file
+
+
+def download_struct_masks(files, ids, res, nocache):
+    """
+    Download several structure masks concurrently
+    and store them in cache.\n
+    The downloads are network bound, so they run in a pool
+    of 8 threads.
+
+    Parameters
+    ----------
+    files: list
+        Downloaded filenames.
+    ids: list of int
+        Allen Mouse Brain Atlas structures ids.
+    res: int
+        Allen resolution [25, 50, 100]
+    nocache: bool
+        Whether use cache of not.
+        Setting nocache to True download the masks again.
+
+    Returns
+    -------
+    list of Path:
+        Cached structure masks files (.nrrd), in the same order as ids.
+    """
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(
+            lambda file, id: download_struct_mask(file, id, res, nocache),
+            files, ids))
 
 
 def download_template_vol(file, res, nocache):
     """
-    Download allen template and store it in cache
-    by default.
+    Download allen template and store it in cache.
+    The cached file is reused by the next calls with the same
+    filename (resolution).
 
     Parameters
     ----------
@@ -202,7 +428,8 @@ def download_template_vol(file, res, nocache):
     res: int
         Allen resolution [25, 50, 100]
     nocache: bool
-        Whether use cache of not
+        Whether use cache of not.
+        Setting nocache to True download the template again.
 
     Returns
     -------
@@ -210,19 +437,24 @@ def download_template_vol(file, res, nocache):
         Allen template volume.
     """
     cache_dir = Path(get_cache_dir())
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    if nocache and os.path.isfile(cache_dir / file):
+        os.remove(cache_dir / file)
     if not os.path.isfile(cache_dir / file):
-        rsa = ReferenceSpaceApi()
-        rsa.download_template_volume(
-            resolution=res,
-            file_name=cache_dir / file
-                )
+        rsa = get_rsa()
+        # Downloading only (no reader), the template is read below
+        retry_allen_download(
+            lambda part: rsa.download_template_volume(
+                resolution=res,
+                file_name=part,
+                strategy='create',
+                reader=None),
+            cache_dir / file)
     vol, hdr = nrrd.read(cache_dir / file)
-    if nocache:
-        os.remove(cache_dir / file)
     return vol
 
 
-def get_unionized_list(exp_id, structs_ids):
+def get_unionized_list(exp_id, structs_ids, mcc=None):
     """
     Get the unionized structures
     of an Allen experiment.
@@ -235,19 +467,56 @@ def get_unionized_list(exp_id, structs_ids):
     struct_ids: list
         Ids of structures in Allen
         Mouse Brain Atlas.
+    mcc: MouseConnectivityCache, optional
+        Cache (from get_mcc()) to reuse.
 
     Returns
     -------
     dataframe: Unionized structures.
     """
-    mcc = get_mcc(nocache=False, res=None)
-    u_list = mcc.get_structure_unionizes(
-        experiment_ids=[exp_id],
-        is_injection=False,
-        structure_ids=structs_ids,
-    )
+    if mcc is None:
+        mcc = get_mcc(nocache=False, res=None)
+    u_list = retry_allen_query(mcc.get_structure_unionizes,
+                               experiment_ids=[exp_id],
+                               is_injection=False,
+                               structure_ids=structs_ids)
+    # Compact ids dtypes (hemispheres are 1, 2, 3)
     return pd.DataFrame(u_list)[['hemisphere_id',
-                                 'structure_id', 'projection_density']]
+                                 'structure_id', 'projection_density']]\
+        .astype({'hemisphere_id': 'int8', 'structure_id': 'int32'})
+
+
+def get_unionized_lists(exps_ids, structs_ids, mcc=None):
+    """
+    Get the unionized structures of several
+    Allen experiments, querying them concurrently.
+    Experiments are cached.\n
+    At most 8 queries run at once, so long lists of
+    experiments are not rate limited by the Allen API.
+
+    Parameters
+    ----------
+    exps_ids: list
+        Ids of Allen experiments.
+    struct_ids: list
+        Ids of structures in Allen
+        Mouse Brain Atlas.
+    mcc: MouseConnectivityCache, optional
+        Cache (from get_mcc()) to reuse.
+
+    Returns
+    -------
+    list of dataframe: Unionized structures of each experiment,
+    in the same order as exps_ids.
+    """
+    if mcc is None:
+        mcc = get_mcc(nocache=False, res=None)
+
+    max_workers = max(1, min(8, len(exps_ids)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda exp_id: get_unionized_list(exp_id, structs_ids, mcc),
+            exps_ids))
 
 
 def search_experiments(injection, spatial, seed_point):
@@ -271,25 +540,28 @@ def search_experiments(injection, spatial, seed_point):
     ------
     dic: Allen experiments founded.
     """
-    mca = MouseConnectivityApi()
+    mca = get_mca()
 
     # Injection coordinate search
     if injection:
-        exps = mca.experiment_injection_coordinate_search(
+        exps = retry_allen_query(
+            mca.experiment_injection_coordinate_search,
             seed_point=seed_point)
 
     # Spatial search
     if spatial:
-        exps = mca.experiment_spatial_search(
-            seed_point=seed_point)
+        exps = retry_allen_query(mca.experiment_spatial_search,
+                                 seed_point=seed_point)
 
     return exps
 
 
+@lru_cache(maxsize=None)
 def get_structure_parents_infos(structure_id):
     """
     Get the path of ids and names of the
     parents of a Allen Mouse Brain Atlas structure.
+    Results are cached, each structure is queried once.
 
     Parameters
     ----------
@@ -302,9 +574,9 @@ def get_structure_parents_infos(structure_id):
     string: Path of parents names's
     """
     # Getting ancestor tree of the structure
-    tsa = TreeSearchApi()
-    tree = tsa.get_tree(kind='Structure', db_id=structure_id,
-                        ancestors=True)
+    tsa = get_tsa()
+    tree = retry_allen_query(tsa.get_tree, kind='Structure',
+                             db_id=structure_id, ancestors=True)
     df_tree = pd.DataFrame(tree)
 
     # Retrieving parents ids and names path
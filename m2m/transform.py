@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import ants
 import nibabel as nib
 import numpy as np
@@ -107,7 +109,7 @@ def get_ornt_UserDataSpace_PIR(user_vol):
     return ornt_user2pir
 
 
-def pretransform_vol_PIR_UserDataSpace(vol, user_vol):
+def pretransform_vol_PIR_UserDataSpace(vol, user_vol, dtype=None):
     """
     Transform a PIR reference space to User Data Space.
 
@@ -117,6 +119,10 @@ def pretransform_vol_PIR_UserDataSpace(vol, user_vol):
         PIR volume to transform.
     user_vol: volume (from nib.load())
         X-oriented volume.
+    dtype: data-type, optional
+        If provided, the transformed volume is returned as a
+        contiguous array of this dtype, reoriented and cast
+        in a single copy. Otherwise a view of vol is returned.
 
     Return
     ------
@@ -127,6 +133,9 @@ def pretransform_vol_PIR_UserDataSpace(vol, user_vol):
         vol,
         get_ornt_PIR_UserDataSpace(user_vol))
 
+    if dtype is not None:
+        vol_reorient = np.ascontiguousarray(vol_reorient, dtype=dtype)
+
     return vol_reorient
 
 
@@ -153,15 +162,40 @@ def pretransform_vol_UserDataSpace_PIR(user_vol, vol):
     return vol_reorient
 
 
+def reorient_point(point, shape, ornt):
+    """
+    Apply nibabel ornt codes to a voxel coordinate, as
+    nib.orientations.apply_orientation() does to a volume.
+
+    Parameters
+    ----------
+    point: tuple, list of ints
+        Voxel coordinate in the input orientation.
+    shape: tuple
+        Shape of the volume in the input orientation.
+    ornt: 3x2 matrix
+        nibabel ornt (output axis and flip of each input axis).
+
+    Returns
+    -------
+    list: Voxel coordinate in the output orientation.
+    """
+    reoriented = [0] * len(point)
+    for axis, (out_axis, flip) in enumerate(ornt):
+        coord = int(point[axis])
+        if flip == -1:
+            coord = shape[axis] - 1 - coord
+        reoriented[int(out_axis)] = coord
+
+    return reoriented
+
+
 def pretransform_point_PIR_UserDataSpace(point,
                                          allen_bbox, user_vol):
     """
     Applying nibabel ornt codes to retrieve allen_coords
     in UserDataSpace orientation (ex: PIR->RAS)
 
-    Process: Create a fake Allen volume, place the point,
-    reorient the volume, get the max of the array
-
     Parameters
     ----------
     point: tuple, list of ints
@@ -175,17 +209,8 @@ def pretransform_point_PIR_UserDataSpace(point,
     -------
     list: Coordinates in UserDataSpace orientation
     """
-    # Creating a fake volume to reorient the point
-    fake_allen_vol = np.zeros(allen_bbox, np.int32)
-    fake_allen_vol[point[0], point[1], point[2]] = 1
-    fake_allen_vol_reorient = pretransform_vol_PIR_UserDataSpace(
-        fake_allen_vol, user_vol)
-
-    # Getting the reoriented point in UserDataSpace
-    x, y, z = np.where(fake_allen_vol_reorient == np.amax(
-        fake_allen_vol_reorient))
-
-    return [x[0], y[0], z[0]]
+    return reorient_point(point, allen_bbox,
+                          get_ornt_PIR_UserDataSpace(user_vol))
 
 
 def pretransform_point_UserDataSpace_PIR(point,
@@ -194,10 +219,6 @@ def pretransform_point_UserDataSpace_PIR(point,
     Applying nibabel ornt codes to retrieve Allen coords
     in UserDataSpace orientation in Allen orientation (ex: RAS->PIR)
 
-    Process: Create a fake Allen volume, reorient the volume,
-    place the point, revert the orientation of the volume,
-    get the max of the array
-
     Parameters
     ----------
     point: tuple, list of ints
@@ -211,23 +232,37 @@ def pretransform_point_UserDataSpace_PIR(point,
     -------
     list: Coordinates in PIR orientation
     """
-    # Creating a fake volume to reorient the point
-    fake_allen_vol = np.zeros(allen_bbox, np.int32)
-    fake_allen_vol_reorient = pretransform_vol_PIR_UserDataSpace(
-        fake_allen_vol, user_vol)
-    fake_allen_vol_reorient[point[0], point[1], point[2]] = 1
+    # Shape of the Allen bounding box oriented in UserDataSpace
+    ornt = get_ornt_PIR_UserDataSpace(user_vol)
+    reoriented_bbox = [0] * len(allen_bbox)
+    for axis, (out_axis, _) in enumerate(ornt):
+        reoriented_bbox[int(out_axis)] = allen_bbox[axis]
 
-    # Getting the reoriented point in PIR voxels
-    fake_allen_vol_reverted = pretransform_vol_UserDataSpace_PIR(
-        user_vol, fake_allen_vol_reorient)
-    x, y, z = np.where(fake_allen_vol_reverted == np.amax(
-        fake_allen_vol_reverted))
+    return reorient_point(point, reoriented_bbox,
+                          get_ornt_UserDataSpace_PIR(user_vol))
 
-    return [x[0], y[0], z[0]]
+
+def create_fixed_image(user_vol):
+    """
+    Create the ANTsPyX fixed image of a User volume.
+    Can be created once and reused by several registrations.
+
+    Parameters
+    ----------
+    user_vol: (from nib.load())
+        User reference volume.
+
+    Return
+    ------
+    ANTsImage: Fixed image.
+    """
+    fixed_res = user_vol.affine[0, 0] * 1000  # micron
+    return ants.from_numpy(user_vol.get_fdata(dtype=np.float32),
+                           spacing=[fixed_res] * 3)
 
 
 def registrate_allen2UserDataSpace(file_mat, allen_vol, user_vol, allen_res,
-                                   smooth=False):
+                                   smooth=False, fixed=None, origin=None):
     """
     Align a 3D allen volume on User volume.
     Using ANTsPyX registration.
@@ -244,6 +279,12 @@ def registrate_allen2UserDataSpace(file_mat, allen_vol, user_vol, allen_res,
         Resolution of the Allen volume, in micron
     smooth: boolean
         bSpline interpolation.
+    fixed: ANTsImage, optional
+        Fixed image (from create_fixed_image()).
+        Created from user_vol if not provided.
+    origin: tuple, optional
+        Position of the first voxel of allen_vol, in micron,
+        when allen_vol is cropped from a full Allen volume.
 
     Return
     ------
@@ -251,10 +292,15 @@ def registrate_allen2UserDataSpace(file_mat, allen_vol, user_vol, allen_res,
     """
     # Creating and reshaping ANTsPyx images for registration
     # Moving : Allen volume
-    # Fixed : AVGT volume
-    fixed_res = user_vol.affine[0, 0] * 1000  # micron
-    fixed = ants.from_numpy(user_vol.get_fdata().astype(np.float32), spacing=[fixed_res] * 3)
-    moving = ants.from_numpy(allen_vol.astype(np.float32), spacing=[allen_res] * 3)
+    # Fixed : User volume
+    if fixed is None:
+        fixed = create_fixed_image(user_vol)
+    # (no copy if the Allen volume is already float32)
+    if origin is None:
+        origin = (0.0,) * 3
+    moving = ants.from_numpy(allen_vol.astype(np.float32, copy=False),
+                             origin=[float(x) for x in origin],
+                             spacing=[allen_res] * 3)
 
     # Selecting interpolator
     interp = 'nearestNeighbor'
@@ -266,6 +312,76 @@ def registrate_allen2UserDataSpace(file_mat, allen_vol, user_vol, allen_res,
                                  interpolator=interp).numpy()
 
 
+def compute_nearest_neighbor_indices(file_mat, allen_shape, user_vol,
+                                     allen_res, fixed=None):
+    """
+    Compute, for each User volume voxel, the Allen voxel sampled by
+    a nearest neighbor registration (registrate_allen2UserDataSpace).
+    The indices are computed once and then align any number of Allen
+    volumes of the same shape with apply_nearest_neighbor_indices().
+
+    Parameters
+    ----------
+    file_mat: str
+        Path to transform matrix
+    allen_shape: tuple
+        Shape of the Allen volumes (oriented in User Data Space).
+    user_vol: (from nib.load())
+        User reference volume.
+    allen_res: float
+        Resolution of the Allen volumes, in micron
+    fixed: ANTsImage, optional
+        Fixed image (from create_fixed_image()).
+        Created from user_vol if not provided.
+
+    Return
+    ------
+    tuple of ndarray: Allen voxel indices along each axis
+        for each User voxel, -1 outside the Allen volume.
+    """
+    if fixed is None:
+        fixed = create_fixed_image(user_vol)
+
+    # Registering the voxel coordinates along each Allen axis,
+    # starting at 1 since 0 is given to the voxels outside the volume
+    indices = []
+    for axis, size in enumerate(allen_shape):
+        grid_shape = [1] * len(allen_shape)
+        grid_shape[axis] = size
+        grid = np.arange(1, size + 1, dtype=np.float32).reshape(grid_shape)
+        grid = np.ascontiguousarray(np.broadcast_to(grid, allen_shape))
+        warped_grid = registrate_allen2UserDataSpace(
+            file_mat, grid, user_vol, allen_res, fixed=fixed)
+        del grid
+        indices.append(np.rint(warped_grid).astype(np.int32) - 1)
+
+    return tuple(indices)
+
+
+def apply_nearest_neighbor_indices(allen_vol, indices):
+    """
+    Align a 3D allen volume on User volume using the indices
+    from compute_nearest_neighbor_indices().
+    Same result as a nearest neighbor registrate_allen2UserDataSpace().
+
+    Parameters
+    ----------
+    allen_vol: ndarray
+        Allen volume to align (oriented in User Data Space).
+    indices: tuple of ndarray
+        Allen voxel indices of each User voxel.
+
+    Return
+    ------
+    ndarray: Warped volume, with the dtype of allen_vol.
+    """
+    inside = indices[0] >= 0
+    warped = np.zeros(inside.shape, dtype=allen_vol.dtype)
+    warped[inside] = allen_vol[tuple(i[inside] for i in indices)]
+
+    return warped
+
+
 def compute_transform_matrix(moving_vol, fixed_vol, moving_res, fixed_res):
     """
     Compute an Affine transformation matrix
@@ -287,8 +403,10 @@ def compute_transform_matrix(moving_vol, fixed_vol, moving_res, fixed_res):
     ------
     string: Path of the transform matrix.
     """
-    moving = ants.from_numpy(moving_vol.astype(np.float32), spacing=[moving_res] * 3)
-    fixed = ants.from_numpy(fixed_vol.get_fdata().astype(np.float32), spacing=[fixed_res] * 3)
+    moving = ants.from_numpy(moving_vol.astype(np.float32, copy=False),
+                             spacing=[moving_res] * 3)
+    fixed = ants.from_numpy(fixed_vol.get_fdata(dtype=np.float32),
+                            spacing=[fixed_res] * 3)
 
     mytx = ants.registration(fixed=fixed,
                              moving=moving,
@@ -297,6 +415,56 @@ def compute_transform_matrix(moving_vol, fixed_vol, moving_res, fixed_res):
     return mytx['fwdtransforms'][0]
 
 
+@lru_cache(maxsize=4)
+def read_transform_matrix(file_mat):
+    """
+    Read an ANTsPyX transform matrix.
+    The transform is cached, so the file is read once
+    for all the points transformed with it.
+
+    Parameters
+    ----------
+    file_mat: str
+        Full path to transformation matrix
+
+    Returns
+    -------
+    ANTsTransform: Transform read from the file.
+    """
+    return ants.read_transform(file_mat)
+
+
+@lru_cache(maxsize=4)
+def read_transform_affine(file_mat):
+    """
+    Read an ANTsPyX linear transform as a NumPy affine.
+    The matrix and offset are probed once from the transform,
+    then points are transformed with a NumPy product.
+
+    Parameters
+    ----------
+    file_mat: str
+        Full path to transformation matrix
+
+    Returns
+    -------
+    ndarray: 3x3 linear part of the transform.
+    ndarray: Offset (translation) of the transform.
+    """
+    tx = read_transform_matrix(file_mat)
+
+    # Images of the origin and of the unit vectors
+    offset = np.asarray(tx.apply_to_point([0.0, 0.0, 0.0]))
+    matrix = np.column_stack([np.asarray(tx.apply_to_point(list(e))) - offset
+                              for e in np.eye(3)])
+
+    # Cached arrays are shared between the calls
+    matrix.flags.writeable = False
+    offset.flags.writeable = False
+
+    return matrix, offset
+
+
 def get_user_coords(allen_coords, res, file_mat, user_vol):
     """
     Retrieve the corresponding coordinate in UserDataSpace of
@@ -329,22 +497,24 @@ def get_user_coords(allen_coords, res, file_mat, user_vol):
     reoriented_coords = pretransform_point_PIR_UserDataSpace(
         allen_pir_vox, allen_bbox, user_vol)
 
-    # Applying invert ANTsPyX transformation on this point
-    tx = ants.read_transform(file_mat)
-    user_coords = tx.invert().apply_to_point(reoriented_coords)
+    # Applying invert transformation on this point
+    # (affine read once, cached)
+    matrix, offset = read_transform_affine(file_mat)
+    user_coords = np.linalg.solve(matrix, np.asarray(reoriented_coords) - offset)
 
     return list(map(int, user_coords))
 
 
-def get_allen_coords(user_coords, res, file_mat, user_vol):
+def get_allen_coords_list(users_coords, res, file_mat, user_vol):
     """
-    Retrieve the corresponding coordinate in the Allen of
-    a specific location in the UserDataSpace
+    Retrieve the corresponding coordinates in the Allen of
+    several locations in the UserDataSpace.
+    The transform is applied to all the points at once.
 
     Parameters
     ----------
-    user_coords: list, tuple
-        User coordinate in voxels
+    users_coords: list of list, tuple
+        User coordinates in voxels
     res: int
         Resolution in the Allen [25, 50, 100]
     file_mat: str
@@ -354,29 +524,52 @@ def get_allen_coords(user_coords, res, file_mat, user_vol):
 
     Returns
     -------
-    user_coords: list of ints
-        Coordinates in the Allen in um
+    list of list of ints
+        Coordinates in the Allen in um, in the same order
     """
     # Selecting Allen bounding box
     allen_bbox = select_allen_bbox(res)
 
-    # Reading transform matrix
-    tx = ants.read_transform(file_mat)
+    # Reading transform affine (cached)
+    matrix, offset = read_transform_affine(file_mat)
 
     # Converting the UDS coordinates from voxel to micron
+    # (one point per row)
     user_res_um = user_vol.affine[0, 0] * 1000
-    user_coords_um = [x * user_res_um for x in user_coords]
+    users_coords_um = np.asarray(users_coords, dtype=float) * user_res_um
 
     # Getting allen um coords in User Data Space
-    allen_um_user = tx.apply_to_point(user_coords_um)
+    allen_um_user = users_coords_um @ matrix.T + offset
 
     # Converting to voxel in the original allen resolution
-    allen_vox_user = [x / res for x in allen_um_user]
-    allen_vox_user = list(map(int, allen_vox_user))
+    allen_vox_user = (allen_um_user / res).astype(int)
+
+    # Reorient the points in Allen Space voxel
+    return [convert_point_to_um(pretransform_point_UserDataSpace_PIR(
+                point, allen_bbox, user_vol), res)
+            for point in allen_vox_user]
 
-    # Reorient the point in Allen Space voxel
-    allen_pir_vox = pretransform_point_UserDataSpace_PIR(
-        allen_vox_user, allen_bbox, user_vol)
 
-    return convert_point_to_um(allen_pir_vox, res)
+def get_allen_coords(user_coords, res, file_mat, user_vol):
+    """
+    Retrieve the corresponding coordinate in the Allen of
+    a specific location in the UserDataSpace
+
+    Parameters
+    ----------
+    user_coords: list, tuple
+        User coordinate in voxels
+    res: int
+        Resolution in the Allen [25, 50, 100]
+    file_mat: str
+        Full path to transformation matrix
+    user_vol: ndarray
+        User volume data array
+
+    Returns
+    -------
+    user_coords: list of ints
+        Coordinates in the Allen in um
+    """
+    return get_allen_coords_list([user_coords], res, file_mat, user_vol)[0]
 
@@ -1,3 +1,4 @@
+import json
 import numpy as np
 import nibabel as nib
 
@@ -32,6 +33,44 @@ def save_nifti(vol, affine, path):
     nib.save(img, path)
 
 
+def save_json(dic, path):
+    """
+    Save a dictionary in a json file, indented with 4 spaces.
+
+    Parameters
+    ----------
+    dic: dict
+        Json content.
+    path: string
+        Path to the output file.
+    """
+    with open(path, "w") as outfile:
+        json.dump(dic, outfile, indent=4)
+
+
+def get_spherical_mask_bbox(shape, radius, center):
+    """
+    Get the bounding box of a spherical mask
+    (from draw_spherical_mask()), clipped to the volume.
+
+    Parameters
+    ----------
+    shape: tuple
+        Shape of the volume.
+    radius: int/float
+        Radius of the spherical mask.
+    center: tuple
+        Position of the center of the spherical mask.
+
+    Return
+    ------
+    tuple of slices: Bounding box of the spherical mask.
+    """
+    return tuple(slice(min(max(int(np.ceil(x0 - radius)), 0), dim),
+                       max(min(int(np.floor(x0 + radius)) + 1, dim), 0))
+                 for x0, dim in zip(center, shape))
+
+
 def draw_spherical_mask(shape, radius, center):
     """
     Generate an n-dimensional spherical mask.
@@ -49,22 +88,45 @@ def draw_spherical_mask(shape, radius, center):
     ------
     ndarray: Volume containing the spherical mask.
     """
-    # Assuming shape and center have the same length and contain ints
+    # Assuming shape and center have the same length
     # (the units are pixels / voxels (px for short),
-    # radius is a int or float in px)
+    # radius and center are ints or floats in px)
     assert len(center) == len(shape)
-    semisizes = (radius,) * len(shape)
+    vol = np.zeros(shape, dtype=bool)
+
+    # Restricting the computation to the bounding box of the sphere
+    # (clipped to the volume)
+    box = get_spherical_mask_bbox(shape, radius, center)
+    if any(s.start >= s.stop for s in box):
+        return vol
 
     # Generating the grid for the support points
     # centered at the position indicated by center
-    grid = [slice(-x0, dim - x0) for x0, dim in zip(center, shape)]
-    center = np.ogrid[grid]
+    grid = [x_i - x0 for x_i, x0 in zip(np.ogrid[box], center)]
+
+    # Squared distance of all points from center,
+    # the inner part of the sphere is below or equal to radius**2
+    dist = sum(x_i ** 2 for x_i in grid)
+    vol[box] = dist <= radius ** 2
+
+    return vol
 
-    # Calculating the distance of all points from center
-    # scaled by the radius
-    vol = np.zeros(shape, dtype=float)
-    for x_i, semisize in zip(center, semisizes):
-        vol += (x_i / semisize) ** 2
 
-    # the inner part of the sphere will have distance below or equal to 1
-    return vol <= 1.0
+def is_in_bbox(coords, shape):
+    """
+    Verify that voxel coordinates are within a volume bounding box.
+
+    Parameters
+    ----------
+    coords: list of int
+        Voxel coordinates [x, y, z].
+    shape: tuple
+        Shape of the volume.
+
+    Return
+    ------
+    bool: Whether the coordinates are in the bounding box.
+    """
+    return 0 <= coords[0] < shape[0] and \
+        0 <= coords[1] < shape[1] and \
+        0 <= coords[2] < shape[2]
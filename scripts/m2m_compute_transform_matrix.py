@@ -14,6 +14,7 @@
 
 import argparse
 import shutil
+import numpy as np
 from m2m.control import (add_cache_arg,
                          add_overwrite_arg,
                          add_reference_arg,
@@ -65,7 +66,8 @@ def main():
     user_vol = load_user_template(str(args.reference))
 
     # Pre-transform volumes orientations
-    allen_reorient = pretransform_vol_PIR_UserDataSpace(allen_vol, user_vol)
+    allen_reorient = pretransform_vol_PIR_UserDataSpace(allen_vol, user_vol,
+                                                        dtype=np.float32)
 
     # Registration with ANTsPyX
     affine_mat = compute_transform_matrix(allen_reorient, user_vol, fixed_res=args.user_res, moving_res=args.res)
@@ -8,11 +8,13 @@
     giving two or three User Data Space (UDS) voxel coordinates.\n
 
     - Generate projection density maps for each experiment.
-      Maps are downloaded from the Allen Mouse Brain Connectivity API.\n
+      Maps are downloaded from the Allen Mouse Brain Connectivity API.
+      Use --no_gzip to save them uncompressed (.nii, faster to write).\n
 
     - Generate a RGB projection density volume combining each
       experiments founded. (--red, --green, --blue).
-      At least two colors (coordinates) are mandatory.\n
+      At least two colors (coordinates) are mandatory.
+      Use --no_rgb to skip it.\n
 
     - Generate a mask at crossing regions if projection density is
       superior to threshold (--threshold) for each experiment founded.
@@ -48,18 +50,19 @@
 """
 
 import argparse
-import json
 import sys
 from pathlib import Path
 
+import nrrd
 import numpy as np
 import pandas as pd
 
-from m2m.allensdk_utils import (download_proj_density_vol,
-                                download_struct_mask_vol,
+from m2m.allensdk_utils import (download_proj_densities,
+                                download_struct_masks,
                                 get_structure_parents_infos,
-                                get_unionized_list,
+                                get_unionized_lists,
                                 get_injection_infos,
+                                get_mcc,
                                 get_mcc_exps,
                                 get_mcc_stree,
                                 search_experiments)
@@ -71,11 +74,16 @@ from m2m.control import (add_cache_arg,
                          add_matrix_arg,
                          add_reference_arg,
                          check_input_file)
-from m2m.transform import (pretransform_vol_PIR_UserDataSpace,
+from m2m.transform import (apply_nearest_neighbor_indices,
+                           compute_nearest_neighbor_indices,
+                           create_fixed_image,
+                           pretransform_vol_PIR_UserDataSpace,
                            registrate_allen2UserDataSpace,
-                           get_allen_coords,
+                           get_allen_coords_list,
                            select_allen_bbox)
-from m2m.util import (save_nifti,
+from m2m.util import (is_in_bbox,
+                      save_json,
+                      save_nifti,
                       load_user_template)
 
 EPILOG = """
@@ -113,6 +121,12 @@ def _build_arg_parser():
                         'masks of crossing ROIs.\n'
                         'Threshold is 0.10 by default.\n'
                         '--threshold <value> will set threshold to value.')
+    p.add_argument('--no_rgb', action="store_true",
+                   help='Do not generate the RGB projection density '
+                        'volume.')
+    p.add_argument('--no_gzip', action="store_true",
+                   help='Save the projection density maps of each '
+                        'experiment uncompressed (.nii).')
     add_resolution_arg(p)
     add_output_dir_arg(p)
     add_cache_arg(p)
@@ -132,12 +146,12 @@ def check_args(parser, args):
         Argument list.
     """
     # Verifying threshold
-    if 0.0 > args.threshold > 1.0:
+    if not 0.0 <= args.threshold <= 1.0:
         parser.error('Please enter a valid threshold value. '
                      'Pick a float value from 0.0 to 1.0')
 
 
-def check_coords_in_bbox(parser, args):
+def check_coords_in_bbox(parser, args, reference):
     """
     Verify that the provided coordinates are within the reference volume bounding box.
 
@@ -147,42 +161,34 @@ def check_coords_in_bbox(parser, args):
         Parser.
     args: argparse namespace
         Argument list.
+    reference: (from nib.load())
+        User reference volume, already loaded.
     """
-    # Load the reference
-    reference = load_user_template(args.reference)
-
     # Verifying coords
-    x, y, z = range(0, reference.shape[0]), range(0, reference.shape[1]), range(0, reference.shape[2])
-    if args.red[0] not in x or \
-            args.red[1] not in y or \
-            args.red[2] not in z:
-        parser.error('Invalid red coordinates'
-                     f'x, y, z values must be in {reference.shape}')
-    if args.green[0] not in x or \
-            args.green[1] not in y or \
-            args.green[2] not in z:
+    if not is_in_bbox(args.red, reference.shape):
+        parser.error('Invalid red coordinates. '
+                     f'x, y, z values must be in {reference.shape}.')
+    if not is_in_bbox(args.green, reference.shape):
         parser.error('Invalid green coordinates. '
                      f'x, y, z values must be in {reference.shape}.')
-    if args.blue:
-        if args.blue[0] not in x or \
-                args.blue[1] not in y or \
-                args.blue[2] not in z:
-            parser.error('Invalid blue coordinates. '
-                         f'x, y, z values must be in {reference.shape}.')
+    if args.blue and not is_in_bbox(args.blue, reference.shape):
+        parser.error('Invalid blue coordinates. '
+                     f'x, y, z values must be in {reference.shape}.')
 
 
-def get_experiment_id(experiments, index, color):
+def get_unique_experiment_id(experiments, used_ids, color):
     """
-    Retrieve an experiment id at a specific index in a list of
-    Allen experiments found with `search_experiments`.\n
-    Notify if there is no experiments.
+    Retrieve the first experiment id, in a list of Allen
+    experiments found with `search_experiments`, that is not
+    already used by another color.\n
+    Notify if there is no such experiment.
 
     Parameters
     ----------
     experiments: dic
         Allen experiments.
-    index: int
-        Index of the experiment needed.
+    used_ids: set
+        Experiments ids already used by the other colors.
     color: string
         Color of the experiment.
         Used to notify if error.
@@ -191,12 +197,54 @@ def get_experiment_id(experiments, index, color):
     ------
     id : Allen experiment id founded.
     """
-    try:
-        id = experiments[index]['id']
-    except (KeyError, TypeError):
-        sys.exit("No experiment founded : {}".format(color))
+    for exp in experiments or []:
+        if exp['id'] not in used_ids:
+            return exp['id']
+
+    sys.exit("No experiment founded : {}".format(color))
+
+
+def is_crossing_2colors(projs, threshold):
+    """
+    Crossing condition of structures for 2 colors.
+    Both projection densities must reach the threshold.
+
+    Parameters
+    ----------
+    projs: list of Series
+        Red and green projection densities.
+    threshold: float
+        Projection density threshold.
+
+    Return
+    ------
+    Series of bool: Whether each structure is a crossing ROI.
+    """
+    red_proj, green_proj = projs
+    return (red_proj >= threshold) & (green_proj >= threshold)
+
+
+def is_crossing_3colors(projs, threshold):
+    """
+    Crossing condition of structures for 3 colors.
+    At least two projection densities must reach the threshold.
+
+    Parameters
+    ----------
+    projs: list of Series
+        Red, green and blue projection densities.
+    threshold: float
+        Projection density threshold.
 
-    return id
+    Return
+    ------
+    Series of bool: Whether each structure is a crossing ROI.
+    """
+    red_above, green_above, blue_above = [proj >= threshold
+                                          for proj in projs]
+    return (red_above & green_above) | \
+        (blue_above & green_above) | \
+        (blue_above & red_above)
 
 
 def main():
@@ -215,27 +263,31 @@ def main():
     user_vol = load_user_template(args.reference)
 
     # Checking that the coords are in the bounding box
-    check_coords_in_bbox(parser, args)
+    check_coords_in_bbox(parser, args, user_vol)
 
     # Checking file mat
     check_input_file(parser, args.file_mat)
 
     # Getting experiments from Mouse Connectivity Cache
-    allen_experiments = get_mcc_exps(args.nocache)
-    stree = get_mcc_stree(args.nocache)
+    # (one cache shared by all the Allen queries of the run)
+    mcc = get_mcc(args.nocache, None)
+    allen_experiments = get_mcc_exps(args.nocache, mcc)
+    stree = get_mcc_stree(args.nocache, mcc)
 
     # Configuring output directory
     args.dir = Path(args.dir)
     args.dir.mkdir(exist_ok=True, parents=True)
 
     # Getting Allen coords
-    allen_red_coords = get_allen_coords(args.red, args.res,
-                                        args.file_mat, user_vol)
-    allen_green_coords = get_allen_coords(args.green, args.res,
-                                          args.file_mat, user_vol)
+    # (all the colors transformed at once)
+    users_coords = [args.red, args.green]
     if args.blue:
-        allen_blue_coords = get_allen_coords(args.blue, args.res,
-                                             args.file_mat, user_vol)
+        users_coords.append(args.blue)
+    allen_coords = get_allen_coords_list(users_coords, args.res,
+                                         args.file_mat, user_vol)
+    allen_red_coords, allen_green_coords = allen_coords[:2]
+    if args.blue:
+        allen_blue_coords = allen_coords[2]
 
     # Searching Allen experiments
     red_exps = search_experiments(args.injection, args.spatial,
@@ -246,23 +298,14 @@ def main():
         blue_exps = search_experiments(args.injection, args.spatial,
                                        allen_blue_coords)
 
-    # Retrieving experiments ids
-    red_id = get_experiment_id(red_exps, 0, "red")
-    green_id = get_experiment_id(green_exps, 0, "green")
-    if args.blue:
-        blue_id = get_experiment_id(blue_exps, 0, "blue")
-
-    if red_id == green_id:
-        green_id = get_experiment_id(green_exps, 1, "green")
+    # Retrieving distinct experiments ids
+    used_ids = set()
+    red_id = get_unique_experiment_id(red_exps, used_ids, "red")
+    used_ids.add(red_id)
+    green_id = get_unique_experiment_id(green_exps, used_ids, "green")
+    used_ids.add(green_id)
     if args.blue:
-        if red_id == blue_id:
-            blue_id = get_experiment_id(blue_exps, 1, "blue")
-            if green_id == blue_id:
-                blue_id = get_experiment_id(blue_exps, 2, "blue")
-        elif green_id == blue_id:
-            blue_id = get_experiment_id(blue_exps, 1, "blue")
-            if red_id == blue_id:
-                blue_id = get_experiment_id(blue_exps, 2, "blue")
+        blue_id = get_unique_experiment_id(blue_exps, used_ids, "blue")
 
     # Preparing files names
     # Creating subdir
@@ -273,17 +316,17 @@ def main():
     subdir.mkdir(exist_ok=True, parents=True)
 
     # Retrieving experiment information
-    rroi = get_injection_infos(allen_experiments, red_id)[0]
-    rloc = get_injection_infos(allen_experiments, red_id)[2]
-    groi = get_injection_infos(allen_experiments, green_id)[0]
-    gloc = get_injection_infos(allen_experiments, green_id)[2]
+    # (one lookup per experiment)
+    rroi, _, rloc = get_injection_infos(allen_experiments, red_id)
+    groi, _, gloc = get_injection_infos(allen_experiments, green_id)
     if args.blue:
-        broi = get_injection_infos(allen_experiments, blue_id)[0]
-        bloc = get_injection_infos(allen_experiments, blue_id)[2]
+        broi, _, bloc = get_injection_infos(allen_experiments, blue_id)
 
     # Projection density maps Niftis and Nrrd files
     nrrd_ = "{}_{}.nrrd"
     nifti_ = "{}_{}_{}_proj_density_{}.nii.gz"
+    if args.no_gzip:
+        nifti_ = "{}_{}_{}_proj_density_{}.nii"
 
     nrrd_red = nrrd_.format(red_id, args.res)
     nifti_red = subdir / nifti_.format(red_id, rroi, rloc, args.res)
@@ -305,7 +348,8 @@ def main():
     nifti_rgb = subdir / rg.format(red_id, green_id, args.res)
     if args.blue:
         nifti_rgb = subdir / rgb.format(red_id, green_id, blue_id, args.res)
-    check_file_exists(parser, args, nifti_rgb)
+    if not args.no_rgb:
+        check_file_exists(parser, args, nifti_rgb)
 
     # X-ROIs mask Nifti file
     mask_ = "{}_{}_x-rois_mask_{}_{}.nii.gz"
@@ -327,143 +371,127 @@ def main():
     check_file_exists(parser, args, xrois_json)
 
     # Downloading projection density maps
-    red_vol = download_proj_density_vol(nrrd_red, red_id,
-                                        args.res, args.nocache)
-    green_vol = download_proj_density_vol(nrrd_green, green_id,
-                                          args.res, args.nocache)
+    exps_ids = [red_id, green_id]
+    nrrd_files = [nrrd_red, nrrd_green]
     if args.blue:
-        blue_vol = download_proj_density_vol(nrrd_blue, blue_id,
-                                             args.res, args.nocache)
-
-    # Transforming manually to RAS+
-    red_vol = pretransform_vol_PIR_UserDataSpace(red_vol, user_vol)
-    green_vol = pretransform_vol_PIR_UserDataSpace(green_vol, user_vol)
-    if args.blue:
-        blue_vol = pretransform_vol_PIR_UserDataSpace(blue_vol, user_vol)
-
-    # Converting Allen volumes to float32
-    red_vol = red_vol.astype(np.float32)
-    green_vol = green_vol.astype(np.float32)
-    if args.blue:
-        blue_vol = blue_vol.astype(np.float32)
-
-    # Applying ANTsPyX registration
-    warped_red = registrate_allen2UserDataSpace(args.file_mat,
-                                                red_vol, user_vol, allen_res=args.res)
-    warped_green = registrate_allen2UserDataSpace(args.file_mat,
-                                                  green_vol, user_vol, allen_res=args.res)
-    if args.blue:
-        warped_blue = registrate_allen2UserDataSpace(args.file_mat,
-                                                     blue_vol, user_vol, allen_res=args.res)
-
-    # Saving Niftis files
-    save_nifti(warped_red, user_vol.affine, nifti_red)
-    save_nifti(warped_green, user_vol.affine, nifti_green)
-    if args.blue:
-        save_nifti(warped_blue, user_vol.affine, nifti_blue)
-
-    # Retrieving user_volume shape
-    user_shape = user_vol.shape
-
-    # Creating RBGA volume (combining maps)
-    rgb_vol = np.zeros((user_shape[0], user_shape[1], user_shape[2], 1, 1),
-                       [('R', 'u1'), ('G', 'u1'), ('B', 'u1'), ('A', 'u1')])
-
-    # Filling the volume with RBG values
-    for i in range(user_shape[0]):
-        for j in range(user_shape[1]):
-            for k in range(user_shape[2]):
-                if args.blue:
-                    if warped_red[i, j, k] == 0 and \
-                            warped_green[i, j, k] == 0 and \
-                            warped_blue[i, j, k] == 0:
-                        rgb_vol[i, j, k] = (0, 0, 0, 0)
-                    else:
-                        rgb_vol[i, j, k] = (warped_red[i, j, k] * 255,
-                                            warped_green[i, j, k] * 255,
-                                            warped_blue[i, j, k] * 255,
-                                            255)
-                else:
-                    if warped_red[i, j, k] == 0 and \
-                            warped_green[i, j, k] == 0:
-                        rgb_vol[i, j, k] = (0, 0, 0, 0)
-                    else:
-                        rgb_vol[i, j, k] = (warped_red[i, j, k] * 255,
-                                            warped_green[i, j, k] * 255,
-                                            0,
-                                            255)
-
-    # Saving Nifti
-    save_nifti(rgb_vol, user_vol.affine, nifti_rgb)
+        exps_ids.append(blue_id)
+        nrrd_files.append(nrrd_blue)
+    nrrd_files = download_proj_densities(nrrd_files, exps_ids,
+                                         args.res, args.nocache)
 
     # Getting Mouse Brain structures ids and names
     # in structure set id "Mouse Connectivity - Target Search"
     structures = stree.get_structures_by_set_id([184527634])
-    structures_ids = pd.DataFrame(structures).id.tolist()
-    structures_acronym = pd.DataFrame(structures).acronym.tolist()
-    structures_names = pd.DataFrame(structures).name.tolist()
+    df_structures = pd.DataFrame(structures,
+                                 columns=['id', 'acronym', 'name'])
+    structures_ids = df_structures.id.tolist()
+
+    # Mapping each structure id to its acronym and name
+    structures_acronyms = dict(zip(structures_ids,
+                                   df_structures.acronym.tolist()))
+    structures_names = dict(zip(structures_ids,
+                                df_structures.name.tolist()))
 
     # Getting structures unionized
-    unionizes_red = get_unionized_list(red_id, structures_ids)
-    unionizes_green = get_unionized_list(green_id, structures_ids)
+    # (one list per color)
+    unionizes = get_unionized_lists(exps_ids, structures_ids, mcc)
+
+    # Projection density of each color
+    # per structure (rows) and hemisphere (1, 2, 3)
+    projs = [u.groupby(['structure_id', 'hemisphere_id'])
+             .projection_density.first() for u in unionizes]
+    projs = pd.concat(projs, axis=1, join='inner')
+    projs = [projs.iloc[:, i] for i in range(projs.shape[1])]
+
+    # Selecting the crossing condition once for the run
+    is_crossing = is_crossing_2colors
     if args.blue:
-        unionizes_blue = get_unionized_list(blue_id, structures_ids)
+        is_crossing = is_crossing_3colors
 
     # Searching crossing regions
-    hem_ids = [1, 2, 3]
-    xrois_ids = []
-    xrois_acronyms = []
-    xrois_names = []
-
-    for id in unionizes_red.structure_id.tolist():
-        # Iterating in each structure
-        red_struct = unionizes_red[unionizes_red.structure_id == id]
-        green_struct = unionizes_green[unionizes_green.structure_id == id]
-        if args.blue:
-            blue_struct = unionizes_blue[unionizes_blue.structure_id == id]
-        # Iterating in each hemisphere
-        for hid in hem_ids:
-            red_hem = red_struct[red_struct.hemisphere_id == hid]
-            green_hem = green_struct[green_struct.hemisphere_id == hid]
-            if args.blue:
-                blue_hem = blue_struct[blue_struct.hemisphere_id == hid]
-            # Getting projection density value
-            red_proj = red_hem.projection_density.tolist()[0]
-            green_proj = green_hem.projection_density.tolist()[0]
-            if args.blue:
-                blue_proj = blue_hem.projection_density.tolist()[0]
-            # Saving crossing rois
-            if red_proj >= args.threshold and \
-                    green_proj >= args.threshold:
-                if id not in xrois_ids:
-                    structure_name = structures_names[
-                        structures_ids.index(id)]
-                    structure_acronym = structures_acronym[
-                        structures_ids.index(id)]
-                    xrois_ids.append(id)
-                    xrois_names.append(structure_name)
-                    xrois_acronyms.append(structure_acronym)
-            if args.blue:
-                if blue_proj >= args.threshold and \
-                        green_proj >= args.threshold:
-                    if id not in xrois_ids:
-                        structure_name = structures_names[
-                            structures_ids.index(id)]
-                        structure_acronym = structures_acronym[
-                            structures_ids.index(id)]
-                        xrois_ids.append(id)
-                        xrois_names.append(structure_name)
-                        xrois_acronyms.append(structure_acronym)
-                if blue_proj >= args.threshold and \
-                        red_proj >= args.threshold:
-                    if id not in xrois_ids:
-                        structure_name = structures_names[
-                            structures_ids.index(id)]
-                        structure_acronym = structures_acronym[
-                            structures_ids.index(id)]
-                        xrois_ids.append(id)
-                        xrois_names.append(structure_name)
-                        xrois_acronyms.append(structure_acronym)
+    # (all structures and hemispheres at once)
+    crossing = is_crossing(projs, args.threshold)
+    crossing = crossing.groupby(level='structure_id').any()
+
+    # Listing the X-ROIs in the order of the first color unionizes
+    xrois_ids = [id for id in unionizes[0].structure_id.unique().tolist()
+                 if crossing.get(id, False)]
+    xrois_acronyms = [structures_acronyms[id] for id in xrois_ids]
+    xrois_names = [structures_names[id] for id in xrois_ids]
+
+    # Aligning with a nearest neighbor index map only when it saves
+    # registrations: the map costs 3 registrations (one per axis), against
+    # one per projection map and one for the merged X-ROIs mask
+    use_nn_indices = len(exps_ids) + (1 if xrois_ids else 0) > 3
+
+    # Creating the ANTsPyX fixed image once for all the registrations
+    fixed = create_fixed_image(user_vol)
+
+    # Creating RBGA channels if not disabled (--no_rgb)
+    # as a plain uint8 array, one channel per last axis index
+    # (no blue channel with 2 colors)
+    if not args.no_rgb:
+        user_shape = user_vol.shape
+        rgba = np.zeros(user_shape + (4,), dtype=np.uint8)
+
+    # Aligning the projection density maps on UDS, one color at a time
+    # (a single Allen volume and a single warped map in memory at once)
+    niftis = [nifti_red, nifti_green]
+    if args.blue:
+        niftis.append(nifti_blue)
+
+    nn_indices = None
+    for channel, (nrrd_file, nifti_file) in enumerate(zip(nrrd_files,
+                                                          niftis)):
+        # Loading the map and transforming it manually to RAS+
+        vol, _ = nrrd.read(nrrd_file)
+        vol = pretransform_vol_PIR_UserDataSpace(vol, user_vol)
+
+        # Computing the nearest neighbor index map once, on the first map
+        # (same Allen grid for all the volumes, and for the ROIs masks)
+        if use_nn_indices and nn_indices is None:
+            nn_indices = compute_nearest_neighbor_indices(
+                args.file_mat, vol.shape, user_vol, allen_res=args.res,
+                fixed=fixed)
+
+        # Aligning the map straight from the reoriented view of the Nrrd
+        # data, then casting the warped map (User grid) to float32
+        # (no copy of the Allen volume, no copy if already float32)
+        if use_nn_indices:
+            warped_vol = apply_nearest_neighbor_indices(vol, nn_indices)
+        else:
+            warped_vol = registrate_allen2UserDataSpace(
+                args.file_mat, vol, user_vol, allen_res=args.res,
+                fixed=fixed)
+        warped_vol = warped_vol.astype(np.float32, copy=False)
+        del vol
+
+        # Saving Nifti file
+        save_nifti(warped_vol, user_vol.affine, nifti_file)
+
+        # Filling the color channel, so the float map can be released
+        # Densities are quantized to bytes in float32, clipped to [0, 255]
+        # Voxels with any projection are marked in the alpha channel
+        if not args.no_rgb:
+            rgba[..., channel] = np.multiply(
+                warped_vol, 255, dtype=np.float32).clip(0, 255)
+            rgba[..., 3] |= warped_vol != 0
+        del warped_vol
+
+    # Creating RGB volume if not disabled (--no_rgb)
+    if not args.no_rgb:
+        # Voxels without any projection stay transparent
+        rgba[..., 3] *= 255
+
+        # Viewing the channels as the RGBA record volume read by MI-Brain
+        # (no copy, trailing singleton dimensions of the Nifti RGBA layout)
+        rgb_vol = rgba.view([('R', 'u1'), ('G', 'u1'),
+                             ('B', 'u1'), ('A', 'u1')]
+                            ).reshape(user_shape + (1, 1))
+
+        # Saving Nifti
+        save_nifti(rgb_vol, user_vol.affine, nifti_rgb)
+        del rgb_vol, rgba
 
     # Verifying if x-rois were found
     if len(xrois_names) == 0:
@@ -472,72 +500,88 @@ def main():
                  "select others coordinates.")
     else:
         # Configuring X-ROIs json file
+        # (one Allen query per ROI)
         parents_ids_paths = []
         parents_names_paths = []
         for id in xrois_ids:
-            parents_ids_path = get_structure_parents_infos(id)[0]
+            parents_ids_path, parents_names_path = \
+                get_structure_parents_infos(id)
             parents_ids_paths.append(parents_ids_path)
-            parents_names_path = get_structure_parents_infos(id)[1]
             parents_names_paths.append(parents_names_path)
 
-        xrois = []
-        for i in range(len(xrois_ids)):
-            roi = {
-                "acronym": xrois_acronyms[i],
-                "name": xrois_names[i],
-                "parents_names": parents_names_paths[i],
-                "parents_ids": parents_ids_paths[i],
-                "id": xrois_ids[i]
-            }
-            xrois.append(roi)
-
-        exps_infos = []
-        exps_ids = [red_id, green_id]
+        xrois = [{"acronym": acronym,
+                  "name": name,
+                  "parents_names": parents_names_path,
+                  "parents_ids": parents_ids_path,
+                  "id": id}
+                 for acronym, name, parents_names_path, parents_ids_path, id
+                 in zip(xrois_acronyms, xrois_names, parents_names_paths,
+                        parents_ids_paths, xrois_ids)]
+
         exps_locs = [rloc, gloc]
         exps_rois = [rroi, groi]
         if args.blue:
-            exps_ids.append(blue_id)
             exps_locs.append(bloc)
             exps_rois.append(broi)
 
-        for i in range(len(exps_ids)):
-            exp = {
-                "id": exps_ids[i],
-                "region": exps_rois[i],
-                "location": exps_locs[i]
-            }
-            exps_infos.append(exp)
+        exps_infos = [{"id": id, "region": roi, "location": loc}
+                      for id, roi, loc in zip(exps_ids, exps_rois, exps_locs)]
 
         dic = {"experiments": exps_infos, "x-rois": xrois}
 
-        json_object = json.dumps(dic, indent=4)
-        with open(xrois_json, "w") as outfile:
-            outfile.write(json_object)
+        save_json(dic, xrois_json)
 
         # Downloading each ROIs masks
         # then merging them into one X-ROIs mask
-        bbox_allen = select_allen_bbox(args.res)
-        mask_combined = np.zeros(bbox_allen)
-
-        for structure_id in xrois_ids:
-            # Creating temporary file
-            mask_nrrd = "{}_{}.nrrd".format(structure_id, args.res)
-            # Downloading structure mask
-            mask = download_struct_mask_vol(mask_nrrd, structure_id,
+        # (the masks are only used for their non-zero pattern, so they
+        # are merged with a boolean OR, in UDS with the index map,
+        # in Allen space before a single registration otherwise)
+        masks_nrrd = ["{}_{}.nrrd".format(structure_id, args.res)
+                      for structure_id in xrois_ids]
+
+        # Downloading the structure masks
+        masks_files = download_struct_masks(masks_nrrd, xrois_ids,
                                             args.res, args.nocache)
-            mask_combined += mask
-
-        # Converting X-ROIs mask to RAS+
-        mask_combined = pretransform_vol_PIR_UserDataSpace(mask_combined,
-                                                           user_vol)
 
-        # Applying ANTsPy registration
-        warped_mask_combined = registrate_allen2UserDataSpace(
-            args.file_mat, mask_combined, user_vol, allen_res=args.res)
+        if use_nn_indices:
+            warped_mask_combined = np.zeros(user_vol.shape, dtype=bool)
+
+            for mask_file in masks_files:
+                # Loading structure mask
+                mask, _ = nrrd.read(mask_file)
+
+                # Converting the mask to RAS+
+                mask = pretransform_vol_PIR_UserDataSpace(mask, user_vol)
+
+                # Aligning the mask with the precomputed index map
+                warped_mask = apply_nearest_neighbor_indices(mask, nn_indices)
+                np.logical_or(warped_mask_combined, warped_mask != 0,
+                              out=warped_mask_combined)
+                del mask, warped_mask
+        else:
+            bbox_allen = select_allen_bbox(args.res)
+            mask_combined = np.zeros(bbox_allen, dtype=bool)
+
+            for mask_file in masks_files:
+                # Loading structure mask
+                mask, _ = nrrd.read(mask_file)
+                np.logical_or(mask_combined, mask != 0, out=mask_combined)
+                del mask
+
+            # Converting X-ROIs mask to RAS+
+            mask_combined = pretransform_vol_PIR_UserDataSpace(mask_combined,
+                                                               user_vol)
+
+            # Applying ANTsPy registration
+            warped_mask_combined = registrate_allen2UserDataSpace(
+                args.file_mat, mask_combined, user_vol, allen_res=args.res,
+                fixed=fixed) != 0
+            del mask_combined
 
         # Improving display in MI-Brain
-        warped_mask_combined = (warped_mask_combined != 0).astype(np.int32)
-        warped_mask_combined[warped_mask_combined > 1] = 1
+        # (binary mask, stored on a single byte per voxel,
+        # the boolean mask is viewed as uint8 without a copy)
+        warped_mask_combined = warped_mask_combined.view(np.uint8)
 
         # Saving Nifti file
         save_nifti(warped_mask_combined, user_vol.affine, xrois_nifti)
@@ -8,7 +8,6 @@ Download the Allen mouse brain annotation for the Adult Mouse (3D), and setting
 import argparse
 from allensdk.core.reference_space_cache import ReferenceSpaceCache
 from pathlib import Path
-import SimpleITK as sitk
 import nrrd
 import numpy as np
 import nibabel as nib
@@ -83,9 +82,7 @@ def main():
     vol, metadata = nrrd.read(str(nrrd_file))
 
     # Converting to PIR to RAS+
-    vol = np.moveaxis(vol, [0, 1, 2], [1, 2, 0])
-    vol = np.flip(vol, axis=1)  # To move from A->P to P->A
-    vol = np.flip(vol, axis=2)  # To move from S->I to I->S
+    vol = vol.transpose(2, 0, 1)[:, ::-1, ::-1]
 
     # Preparing the affine
     r_mm = args.resolution / 1e3  # Convert the resolution from micron to mm
@@ -104,14 +101,10 @@ def main():
     if args.reference is not None and args.file_mat is not None:
         user_vol = load_user_template(args.reference)
 
-        # Load the allen template
-        allen_vol = load_user_template(str(output))
-        allen_vol = allen_vol.get_fdata()
-
         # Applying ANTsPyX registration
         warped_vol = registrate_allen2UserDataSpace(
             args.file_mat,
-            allen_vol,
+            vol,
             user_vol,
             allen_res=args.resolution,
             smooth=False
@@ -59,9 +59,9 @@ def main():
     vol, metadata = rpa.download_template_volume(resolution=args.resolution, file_name=nrrd_file)
 
     # Converting to PIR to RAS+
-    vol = np.moveaxis(vol, [0, 1, 2], [1, 2, 0])
-    vol = np.flip(vol, axis=1)  # To move from A->P to P->A
-    vol = np.flip(vol, axis=2)  # To move from S->I to I->S
+    # (a single view: PIR->RPI axes order, then A->P to P->A
+    # and S->I to I->S flips with negative strides)
+    vol = vol.transpose(2, 0, 1)[:, ::-1, ::-1]
 
     # Preparing the affine
     r_mm = args.resolution / 1e3  # Convert the resolution from micron to mm
@@ -77,21 +77,19 @@ def main():
     if args.reference is not None and args.file_mat is not None:
         user_vol = load_user_template(args.reference)
 
-        # Load the allen template
-        allen_vol = load_user_template(str(output))
-        allen_vol = allen_vol.get_fdata()
-
         # Applying ANTsPyX registration
+        # (on the RAS+ volume still in memory, instead of reloading
+        # the Nifti just saved)
         warped_vol = registrate_allen2UserDataSpace(
             args.file_mat,
-            allen_vol,
+            vol,
             user_vol,
             allen_res=args.resolution,
             smooth=True
         )
 
         # Deleting negatives values introduced by b-spline interpolation
-        warped_vol[warped_vol < 0] = 0
+        np.maximum(warped_vol, 0, out=warped_vol)
 
         # Saving the warped volume
         save_nifti(warped_vol, user_vol.affine, args.output)
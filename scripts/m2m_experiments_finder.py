@@ -43,7 +43,8 @@ from m2m.control import (add_cache_arg,
                          check_file_exists,
                          check_input_file)
 from m2m.transform import get_allen_coords
-from m2m.util import load_user_template
+from m2m.util import (is_in_bbox,
+                      load_user_template)
 
 EPILOG = """
 Author : Mahdi
@@ -82,7 +83,7 @@ def _build_arg_parser():
     return p
 
 
-def check_coords_in_bbox(parser, args):
+def check_coords_in_bbox(parser, args, reference):
     """
     Verify that the provided coordinates are within the reference
     volume bounding box.
@@ -93,15 +94,11 @@ def check_coords_in_bbox(parser, args):
         Parser.
     args: argparse namespace
         Argument list.
+    reference: (from nib.load())
+        User reference volume, already loaded.
     """
-    # Load the reference
-    reference = load_user_template(args.reference)
-
     # Verifying coords
-    x, y, z = range(0, reference.shape[0]), range(0, reference.shape[1]), range(0, reference.shape[2])
-    if args.x not in x or \
-            args.y not in y or \
-            args.z not in z:
+    if not is_in_bbox([args.x, args.y, args.z], reference.shape):
         parser.error('Invalid coordinates '
                      f'x, y, z values must be in {reference.shape} at {args.res} microns')
 
@@ -119,7 +116,7 @@ def main():
     user_vol = load_user_template(args.reference)
 
     # Checking that the coords are in the bounding box
-    check_coords_in_bbox(parser, args)
+    check_coords_in_bbox(parser, args, user_vol)
 
     # Checking file mat
     check_input_file(parser, args.file_mat)
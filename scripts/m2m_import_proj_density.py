@@ -49,8 +49,8 @@
 """
 
 import argparse
-import json
 from pathlib import Path
+import nrrd
 import numpy as np
 import pandas as pd
 from m2m.control import (add_cache_arg,
@@ -61,15 +61,19 @@ from m2m.control import (add_cache_arg,
                          add_resolution_arg,
                          check_file_exists,
                          check_input_file)
-from m2m.transform import (get_user_coords,
+from m2m.transform import (create_fixed_image,
+                           get_user_coords,
+                           pretransform_point_PIR_UserDataSpace,
                            pretransform_vol_PIR_UserDataSpace,
                            registrate_allen2UserDataSpace,
                            select_allen_bbox)
-from m2m.allensdk_utils import (download_proj_density_vol,
+from m2m.allensdk_utils import (download_proj_densities,
                                 get_injection_infos,
                                 get_mcc_exps)
 from m2m.util import (draw_spherical_mask,
+                      get_spherical_mask_bbox,
                       load_user_template,
+                      save_json,
                       save_nifti, )
 
 EPILOG = """
@@ -169,6 +173,9 @@ def main():
         in_ids = [args.id]
     if args.ids_csv:
         in_ids = pd.read_csv(args.ids_csv).id.tolist()
+
+    # Removing duplicated ids, keeping their order
+    in_ids = list(dict.fromkeys(in_ids))
      
     # Verifying experiment id
     invalid_ids = [x for x in in_ids if x not in ids]
@@ -178,17 +185,14 @@ def main():
                     "Please check: https://connectivity.brain-map.org/"
                     .format(invalid_ids_str))
 
-
-    # Iterating on each id
+    # Configuring outputs filenames of each id
+    # and verifying if files exists, before any download
+    outputs = {}
     for id in in_ids:
-
         # Experiment infos
         # injection region, location, position (inj_coords_um)
-        roi = get_injection_infos(allen_experiments, id)[0]
-        loc = get_injection_infos(allen_experiments, id)[2]
-        pos = get_injection_infos(allen_experiments, id)[1]
+        roi, pos, loc = get_injection_infos(allen_experiments, id)
 
-        # Configuring outputs filenames
         file_map = args.dir / "{}_{}_{}_proj_density_{}.nii.gz"\
                             .format(id, roi, loc, args.res)
         if args.smooth:
@@ -208,6 +212,24 @@ def main():
             if args_list[file_list.index(file)] or not args.not_all:
                 check_file_exists(parser, args, file)
 
+        outputs[id] = (roi, pos, loc, file_list)
+
+    # Creating the ANTsPyX fixed image once for all the registrations
+    fixed = None
+    if args.map or args.bin or args.roi:
+        fixed = create_fixed_image(user_vol)
+
+    # Downloading the projection density maps
+    if args.map or args.bin:
+        nrrd_files = ["{}_{}.nrrd".format(id, args.res) for id in in_ids]
+        nrrd_files = dict(zip(in_ids, download_proj_densities(
+            nrrd_files, in_ids, args.res, args.nocache)))
+
+    # Iterating on each id
+    for id in in_ids:
+        roi, pos, loc, file_list = outputs[id]
+        file_map, file_roi, file_infos, file_bin = file_list
+
         # Creating and Saving MI-brain injection coordinates coords in json file
         # Saving experiments infos if --infos was used
         if args.infos:
@@ -221,21 +243,16 @@ def main():
                 "allen_micron": str(pos), "mibrain_voxels": str(mib_coords)}
 
             # Saving in json file
-            json_object = json.dumps(dic, indent=4)
-            with open(file_infos, "w") as outfile:
-                outfile.write(json_object)
+            save_json(dic, file_infos)
 
         # Downloading and Saving the projection density map if --map was used
         if args.map or args.bin:
-            # Configuring files names
-            nrrd_file = "{}_{}.nrrd".format(id, args.res)
-
-            # Downloading projection density (API)
-            allen_vol = download_proj_density_vol(nrrd_file, id,
-                                                  args.res, args.nocache)
+            # Loading the downloaded projection density
+            allen_vol, _ = nrrd.read(nrrd_files[id])
 
             # Transforming manually to RAS+
-            allen_vol = pretransform_vol_PIR_UserDataSpace(allen_vol, user_vol)
+            allen_vol = pretransform_vol_PIR_UserDataSpace(allen_vol, user_vol,
+                                                           dtype=np.float32)
 
             # Applying ANTsPyX registration
             warped_vol = registrate_allen2UserDataSpace(
@@ -243,12 +260,13 @@ def main():
                 allen_vol,
                 user_vol,
                 allen_res=args.res,
-                smooth=args.smooth
+                smooth=args.smooth,
+                fixed=fixed
             )
 
             # Deleting negatives values if bSpline method was used (--smooth)
             if args.smooth:
-                warped_vol[warped_vol < 0] = 0
+                np.maximum(warped_vol, 0, out=warped_vol)
 
             if args.map:
                 # Creating and Saving the Nifti map
@@ -256,7 +274,9 @@ def main():
 
             if args.bin:
                 # Creating and Saving the Nifti bin map
-                bin_vol = (warped_vol >= args.threshold).astype(np.int32)
+                # (binary map, stored on a single byte per voxel,
+                # the boolean map is viewed as uint8 without a copy)
+                bin_vol = (warped_vol >= args.threshold).view(np.uint8)
                 save_nifti(bin_vol, user_vol.affine, file_bin)
 
         # Creating and Saving the spherical mask if --roi was used
@@ -268,27 +288,49 @@ def main():
 
             # Configuring the bounding box
             bbox_allen = select_allen_bbox(args.res)
+            radius = 400//args.res
+
+            # Bounding box of the sphere in the Allen volume
+            # (with a margin of one empty voxel)
+            box = get_spherical_mask_bbox(bbox_allen, radius,
+                                          inj_coord_voxels)
+            box = tuple(slice(max(s.start - 1, 0), min(s.stop + 1, dim))
+                        for s, dim in zip(box, bbox_allen))
 
-            # Drawing the spherical mask
+            # Drawing the spherical mask within its bounding box only
+            # (the rest of the Allen volume is empty)
             roi_sphere_allen = draw_spherical_mask(
-                shape=bbox_allen,
-                center=inj_coord_voxels,
-                radius=400//args.res)
+                shape=tuple(s.stop - s.start for s in box),
+                center=[x0 - s.start
+                        for x0, s in zip(inj_coord_voxels, box)],
+                radius=radius)
 
             # Transforming manually to RAS+
-            roi_sphere_allen = pretransform_vol_PIR_UserDataSpace(roi_sphere_allen,
-                                                                user_vol)
+            roi_sphere_allen = pretransform_vol_PIR_UserDataSpace(
+                roi_sphere_allen, user_vol, dtype=np.float32)
+
+            # Position of the box in the Allen volume transformed to RAS+
+            # (its first voxel, among its two transformed corners)
+            corners = [pretransform_point_PIR_UserDataSpace(
+                           corner, bbox_allen, user_vol)
+                       for corner in ([s.start for s in box],
+                                      [s.stop - 1 for s in box])]
+            origin = [min(coords) * args.res for coords in zip(*corners)]
 
             # Applying ANTsPyX registration
+            # (nearest neighbor, the cropped mask keeps its Allen position)
             roi_sphere_avgt = registrate_allen2UserDataSpace(
                 args.file_mat,
                 roi_sphere_allen,
                 user_vol,
                 allen_res=args.res,
+                fixed=fixed,
+                origin=origin
             )
 
             # Deleting non needed interpolated values
-            roi_sphere_avgt = roi_sphere_avgt.astype(np.int32)
+            # (binary mask, stored on a single byte per voxel)
+            roi_sphere_avgt = roi_sphere_avgt.astype(np.uint8)
 
             # Creating and Saving the Nifti spherical mask
             save_nifti(roi_sphere_avgt, user_vol.affine, file_roi)